@@ -1,8 +1,845 @@
 
 import streamlit as st
-import requests
+import aiohttp
+import diskcache
+import faiss
+import httpx
+import numpy as np
+import pandas as pd
+import tenacity
 import openai
+import orjson
+import tiktoken
 import math
+import asyncio
+import collections
+import hashlib
+import itertools
+import json
+import re
+import queue
+import threading
+import time
+
+# Posting phrases that rule a job out, the word tokenizer for title keyword
+# matching, and company-name words that mark an agency. All three are matched
+# against text lowercased once per job.
+BLOCK_RE = re.compile(r"no (?:recruiters|agencies|recruitment agenc(?:ies|y))\b")
+TOKEN_RE = re.compile(r"[a-z0-9]+")
+AGENCY_TERMS = ("staffing", "recruiting", "recruitment", "talent", "consulting", "agency")
+AGENCY_RE = re.compile("|".join(AGENCY_TERMS))
+
+# Where GPT verdicts are cached on disk, and how long a company's agency
+# verdict is trusted, in seconds
+GPT_CACHE_DIR = "./gpt_cache"
+AGENCY_CACHE_TTL = 86400
+# Fit analyses also kept in process memory, most recently used first
+FIT_MEMO_SIZE = 4096
+# Legal-form suffixes dropped from company names before caching verdicts
+COMPANY_SUFFIX_RE = re.compile(r"[\s,.]+(?:inc|llc|l\.l\.c|corp|corporation|co|ltd|company)\.?$")
+
+# Well-known staffing and recruiting firms. Company names are compared to these
+# by embedding similarity: above the match threshold is an agency, below the
+# borderline threshold is not, and anything in between is asked of GPT.
+AGENCY_SEED_NAMES = (
+    "Robert Half", "Aerotek", "Adecco", "Randstad", "ManpowerGroup", "Kelly Services",
+    "Kforce", "TEKsystems", "Insight Global", "Allegis Group", "Express Employment Professionals",
+    "Spherion", "Volt Workforce Solutions", "Beacon Hill Staffing Group", "Hays", "Michael Page",
+    "Korn Ferry", "Heidrick & Struggles", "Aston Carter", "Actalent", "Apex Systems",
+    "Robert Walters", "Hudson RPO", "CyberCoders", "Motion Recruitment", "Jobot", "Vaco",
+    "Addison Group", "System One", "Yoh", "Akkodis", "Experis", "LanceSoft", "Mastech Digital",
+    "Collabera", "The Judge Group", "PeopleReady", "Labor Finders", "Tradesmen International",
+    "Trillium Staffing", "Staffmark", "AppleOne", "OfficeTeam", "Nesco Resource", "Atrium Staffing",
+    "Integrity Staffing Solutions", "Snelling Staffing", "Elwood Staffing", "BelFlex Staffing",
+    "CLP Resources",
+)
+AGENCY_MATCH_SIMILARITY = 0.78
+AGENCY_BORDERLINE_SIMILARITY = 0.65
+
+# Recruiter-fit analyses are reused for postings whose description embedding is
+# at least this cosine-similar to one already analyzed
+EMBEDDING_MODEL = "text-embedding-3-small"
+EMBEDDING_DIM = 1536
+FIT_CACHE_SIMILARITY = 0.93
+
+# Static instructions go in the system message and only the per-call data in
+# the user message, so every request shares an identical prompt prefix that
+# OpenAI's prompt caching can reuse
+SCREENING_INSTRUCTIONS = (
+    "You are an AI assistant helping a recruiter. For each numbered posting you are given, "
+    "decide whether the company is a staffing or recruiting agency, and whether the job "
+    "post suggests the company might be open to working with external recruiters. "
+    'Return JSON: {"results": [{"id": <posting number>, "is_agency": true|false, '
+    '"analysis": "<one or two sentences>"}]} with one entry per posting.'
+)
+AGENCY_CHECK_INSTRUCTIONS = "You are a business classifier. Only respond with 'Yes' or 'No'."
+AGENCY_BATCH_INSTRUCTIONS = (
+    "You are a business classifier. For each numbered company, answer only Yes or No "
+    "whether it is a staffing or recruiting agency. "
+    'Return compact JSON on one line: {"answers": ["Yes" or "No", ...]} with one answer '
+    "per company, in order."
+)
+
+# Result table layout; the Link column holds the raw posting URL
+RESULT_COLUMNS = ["Company", "Job Title", "Link", "AI Analysis"]
+RESULT_COLUMN_CONFIG = {"Link": st.column_config.LinkColumn("Posting Link", display_text="Open Posting")}
+# Exclusions log layout and how many of its rows are shown on the page
+EXCLUSION_COLUMNS = ["Company", "Job Title", "Reason"]
+EXCLUSIONS_SHOWN = 30
+
+# Chat model for screening and agency checks: lower latency, cost and higher
+# rate limits than gpt-3.5-turbo
+GPT_MODEL = "gpt-4o-mini"
+
+ADZUNA_SEARCH_URL = "https://api.adzuna.com/v1/api/jobs/us/search/{page}"
+# Adzuna paging: page 1 is fetched first and the share of its postings that
+# survive the local filters decides how many more pages to fetch, assuming at
+# least the minimum yield and never more than the page limit in total
+ADZUNA_RESULTS_PER_PAGE = 50
+ADZUNA_MAX_PAGES = 5
+ADZUNA_MIN_YIELD = 0.1
+# Max number of GPT screening requests in flight at once
+GPT_CONCURRENCY = 10
+# Number of postings packed into a single screening request
+GPT_BATCH_SIZE = 8
+# Postings with no agency verdict yet that are sent to GPT, as a multiple of
+# max_results, to leave room for the ones that turn out to be agencies
+OVER_REQUEST_FACTOR = 1.5
+# Default OpenAI rate limits, adjustable in the sidebar
+DEFAULT_MAX_REQUESTS_PER_MINUTE = 3500
+DEFAULT_MAX_TOKENS_PER_MINUTE = 90000
+# Attempts per OpenAI call on a 429, dropped connection or server error, with
+# jittered exponential backoff between them, in seconds
+GPT_MAX_ATTEMPTS = 4
+GPT_BACKOFF_INITIAL = 1
+GPT_BACKOFF_MAX = 20
+# How long a search waits on a Batch API agency job before leaving it to
+# finish in the background, in seconds
+BATCH_API_MAX_WAIT = 300
+# Disk-cache key prefix of the Batch API agency jobs still being waited on,
+# tracked per API key since a batch only exists for the key that created it
+AGENCY_BATCHES_KEY = "agency_batches_v2"
+# Companies classified per agency-check request, and the output token budget:
+# per company, plus the JSON wrapper. A compact answer takes about 2 tokens per
+# company; the rest is headroom for whitespace JSON mode may add.
+AGENCY_BATCH_SIZE = 20
+AGENCY_TOKENS_PER_COMPANY = 6
+AGENCY_TOKENS_OVERHEAD = 20
+# Characters of each description sent to GPT; the opening carries the
+# company-culture and recruiter-policy signals the fit check needs
+GPT_DESC_CHARS = 800
+# Output token budget per posting in a batch
+GPT_TOKENS_PER_JOB = 120
+
+
+@st.cache_resource
+def get_event_loop():
+    # One long-lived event loop on a daemon thread. The cached async clients
+    # below keep connections bound to the loop they were opened on, so every
+    # coroutine in the app runs here via run_async.
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return loop
+
+
+def run_async(coro):
+    return asyncio.run_coroutine_threadsafe(coro, get_event_loop()).result()
+
+
+@st.cache_resource
+def get_openai(api_key):
+    # Reused across reruns so the keep-alive connection to api.openai.com is too.
+    # The SDK's own retries are off; gpt_retry and the rate limiter own them.
+    return openai.AsyncOpenAI(api_key=api_key, max_retries=0)
+
+
+@st.cache_resource
+def get_http_session():
+    # Pooled keep-alive session for Adzuna, shared across reruns and sessions.
+    # Idle connections are kept for a minute so the TLS session usually
+    # survives the gap between searches, and payloads are requested gzipped.
+    async def create():
+        return aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=10, limit_per_host=8, keepalive_timeout=60),
+            timeout=aiohttp.ClientTimeout(total=10),
+            headers={"Accept-Encoding": "gzip"}
+        )
+
+    return run_async(create())
+
+
+class RateLimiter:
+    # Token buckets for requests and tokens per minute, after the OpenAI
+    # Cookbook's parallel request processor: capacity refills continuously and
+    # each call waits until both buckets can cover it, so the fan-out runs at
+    # the limit without tripping it. A 429 halves the request rate; every 50
+    # successes after that win back 10%, up to the configured limit.
+    def __init__(self):
+        self.max_requests_per_minute = DEFAULT_MAX_REQUESTS_PER_MINUTE
+        self.max_tokens_per_minute = DEFAULT_MAX_TOKENS_PER_MINUTE
+        self.requests_per_minute = self.max_requests_per_minute
+        self.available_request_capacity = self.requests_per_minute
+        self.available_token_capacity = self.max_tokens_per_minute
+        self.last_update = time.monotonic()
+        self.successes = 0
+
+    def configure(self, max_requests_per_minute, max_tokens_per_minute):
+        # Without a 429 backoff in progress the rate follows the new limit,
+        # raised or lowered; while backing off it can only come down
+        backing_off = self.requests_per_minute < self.max_requests_per_minute
+        self.max_requests_per_minute = max_requests_per_minute
+        self.max_tokens_per_minute = max_tokens_per_minute
+        if backing_off:
+            self.requests_per_minute = min(self.requests_per_minute, max_requests_per_minute)
+        else:
+            self.requests_per_minute = max_requests_per_minute
+        self.available_request_capacity = min(self.available_request_capacity, self.requests_per_minute)
+        self.available_token_capacity = min(self.available_token_capacity, max_tokens_per_minute)
+
+    def refill(self):
+        now = time.monotonic()
+        elapsed = now - self.last_update
+        self.last_update = now
+        self.available_request_capacity = min(
+            self.requests_per_minute,
+            self.available_request_capacity + self.requests_per_minute * elapsed / 60
+        )
+        self.available_token_capacity = min(
+            self.max_tokens_per_minute,
+            self.available_token_capacity + self.max_tokens_per_minute * elapsed / 60
+        )
+
+    async def acquire(self, tokens):
+        # A request bigger than a whole minute's budget only waits for a full bucket
+        tokens = min(tokens, self.max_tokens_per_minute)
+        while True:
+            self.refill()
+            if self.available_request_capacity >= 1 and self.available_token_capacity >= tokens:
+                self.available_request_capacity -= 1
+                self.available_token_capacity -= tokens
+                return
+            await asyncio.sleep(0.05)
+
+    def record_success(self):
+        self.successes += 1
+        if self.successes >= 50 and self.requests_per_minute < self.max_requests_per_minute:
+            self.requests_per_minute = min(self.max_requests_per_minute, self.requests_per_minute * 1.1)
+            self.successes = 0
+
+    def record_rate_limit(self):
+        self.requests_per_minute = max(1, self.requests_per_minute / 2)
+        self.available_request_capacity = min(self.available_request_capacity, self.requests_per_minute)
+        self.successes = 0
+
+
+@st.cache_resource
+def get_rate_limiter(api_key):
+    # Limits apply per API key, so all sessions using a key share one limiter
+    return RateLimiter()
+
+
+def is_quota_exhausted(error):
+    # Out of credit arrives as a 429 too, but waiting won't fix it
+    return isinstance(error, openai.RateLimitError) and error.code == "insufficient_quota"
+
+
+def is_retryable(error):
+    # The errors the SDK itself would retry: 429s, dropped connections and
+    # timeouts, and server errors
+    if is_quota_exhausted(error):
+        return False
+    return isinstance(error, (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError))
+
+
+# Retry policy for OpenAI calls, with jittered exponential backoff; any other
+# error, or a retryable one on the last attempt, is raised
+gpt_retry = tenacity.retry(
+    retry=tenacity.retry_if_exception(is_retryable),
+    wait=tenacity.wait_exponential_jitter(initial=GPT_BACKOFF_INITIAL, max=GPT_BACKOFF_MAX),
+    stop=tenacity.stop_after_attempt(GPT_MAX_ATTEMPTS),
+    reraise=True
+)
+
+
+@gpt_retry
+async def create_completion(client, limiter, tokens, **request):
+    # One chat completion paced by the rate limiter; tokens is the rough cost
+    # counted against the per-minute budget. A 429 also slows the limiter.
+    await limiter.acquire(tokens)
+    try:
+        return await client.chat.completions.create(**request)
+    except openai.RateLimitError as e:
+        if not is_quota_exhausted(e):
+            limiter.record_rate_limit()
+        raise
+
+
+async def fetch_pages(session, params, pages):
+    # Adzuna search pages are independent, so fetch them all concurrently over
+    # the shared pooled session. A failed page comes back as its exception
+    # instead of cancelling the others. Bodies are parsed with orjson, which
+    # is faster than the stdlib json behind response.json().
+    async def fetch(page):
+        async with session.get(ADZUNA_SEARCH_URL.format(page=page), params=params) as response:
+            response.raise_for_status()
+            return orjson.loads(await response.read()).get("results", [])
+
+    return await asyncio.gather(*[fetch(page) for page in pages], return_exceptions=True)
+
+
+@st.cache_data(ttl=300, show_spinner=False)
+def fetch_adzuna(query, pages, app_id, app_key):
+    # Cached for a few minutes so repeat searches skip HTTP and JSON parsing.
+    # Any failed page raises, which keeps the failure out of the cache.
+    params = {
+        "app_id": app_id,
+        "app_key": app_key,
+        "results_per_page": ADZUNA_RESULTS_PER_PAGE,
+        "what": query,
+        "content-type": "application/json"
+    }
+    results = run_async(fetch_pages(get_http_session(), params, pages))
+    failures = [f"page {page}: {jobs}" for page, jobs in zip(pages, results) if isinstance(jobs, Exception)]
+    if failures:
+        raise RuntimeError("; ".join(failures))
+    return list(itertools.chain.from_iterable(results))
+
+
+def extra_pages_needed(fetched, survivors, max_results):
+    # Pages beyond the first likely to bring the survivors up to max_results.
+    # fetched is the raw size of page 1; a short page means Adzuna has no more.
+    if survivors >= max_results or fetched < ADZUNA_RESULTS_PER_PAGE:
+        return 0
+    yield_rate = max(survivors / ADZUNA_RESULTS_PER_PAGE, ADZUNA_MIN_YIELD)
+    needed = math.ceil((max_results - survivors) / (ADZUNA_RESULTS_PER_PAGE * yield_rate))
+    return min(needed, ADZUNA_MAX_PAGES - 1)
+
+
+@st.cache_resource
+def get_gpt_cache():
+    # On-disk cache of GPT verdicts shared by every session and kept across
+    # restarts. Keys carry a version tag so a prompt change can retire them.
+    return diskcache.Cache(GPT_CACHE_DIR)
+
+
+def has_block_phrase(text_l):
+    # BLOCK_RE starts with a plain literal so _sre can jump between "no "
+    # occurrences with its fast literal search; a leading \b or re.I would
+    # turn that into a per-character scan, so the text is lowercased up front
+    # and the left word boundary is checked here
+    return any(m.start() == 0 or not text_l[m.start() - 1].isalnum() for m in BLOCK_RE.finditer(text_l))
+
+
+def normalize_company(company_l):
+    return COMPANY_SUFFIX_RE.sub("", company_l.strip()).strip(" ,.")
+
+
+def description_digest(desc):
+    return hashlib.sha1(desc.strip().encode("utf-8")).hexdigest()
+
+
+def cached_agency_verdict(company_norm):
+    return get_gpt_cache().get(("agency_v1", company_norm))
+
+
+def remember_agency_verdict(company_norm, is_agency):
+    get_gpt_cache().set(("agency_v1", company_norm), is_agency, expire=AGENCY_CACHE_TTL)
+
+
+@st.cache_resource
+def get_fit_memo():
+    # Bounded in-process layer over the disk cache for fit analyses, so
+    # repeated postings skip the SQLite round trip too
+    return {"analyses": collections.OrderedDict(), "lock": threading.Lock()}
+
+
+def fit_cache_key(digest):
+    # The model is part of the key so a model change never reuses old analyses
+    return ("fit_v1", GPT_MODEL, digest)
+
+
+def cached_fit_analysis(digest):
+    memo = get_fit_memo()
+    key = fit_cache_key(digest)
+    with memo["lock"]:
+        if key in memo["analyses"]:
+            memo["analyses"].move_to_end(key)
+            return memo["analyses"][key]
+    analysis = get_gpt_cache().get(key)
+    if analysis is not None:
+        remember_fit_memo(memo, key, analysis)
+    return analysis
+
+
+def remember_fit_analysis(digest, analysis):
+    key = fit_cache_key(digest)
+    get_gpt_cache().set(key, analysis)
+    remember_fit_memo(get_fit_memo(), key, analysis)
+
+
+def remember_fit_memo(memo, key, analysis):
+    with memo["lock"]:
+        memo["analyses"][key] = analysis
+        memo["analyses"].move_to_end(key)
+        while len(memo["analyses"]) > FIT_MEMO_SIZE:
+            memo["analyses"].popitem(last=False)
+
+
+@st.cache_resource
+def get_fit_cache():
+    # Recruiter-fit analyses indexed by description embedding, shared across
+    # reruns and sessions. Embeddings are unit length, so inner product is
+    # cosine similarity.
+    return {"index": faiss.IndexFlatIP(EMBEDDING_DIM), "analyses": [], "lock": threading.Lock()}
+
+
+def lookup_fit_analyses(embeddings):
+    cache = get_fit_cache()
+    with cache["lock"]:
+        if cache["index"].ntotal == 0:
+            return [None] * len(embeddings)
+        sims, ids = cache["index"].search(embeddings, 1)
+        return [
+            cache["analyses"][i] if sim > FIT_CACHE_SIMILARITY else None
+            for sim, i in zip(sims[:, 0], ids[:, 0])
+        ]
+
+
+def remember_fit_analyses(embeddings, analyses):
+    cache = get_fit_cache()
+    with cache["lock"]:
+        cache["index"].add(embeddings)
+        cache["analyses"].extend(analyses)
+
+
+@gpt_retry
+async def embed_texts(client, texts):
+    # One embeddings request for every text, normalized to unit length
+    response = await client.embeddings.create(
+        model=EMBEDDING_MODEL,
+        input=[text or " " for text in texts]
+    )
+    embeddings = np.array([item.embedding for item in response.data], dtype="float32")
+    faiss.normalize_L2(embeddings)
+    return embeddings
+
+
+@st.cache_resource(show_spinner=False)
+def get_seed_embeddings(api_key):
+    return run_async(embed_texts(get_openai(api_key), list(AGENCY_SEED_NAMES)))
+
+
+def classify_agencies_locally(embeddings, seeds):
+    # True/False where the closest known agency name is clearly similar or
+    # clearly not; None for the borderline band that is left to GPT
+    scores = (embeddings @ seeds.T).max(axis=1)
+    return [
+        True if score > AGENCY_MATCH_SIMILARITY else False if score < AGENCY_BORDERLINE_SIMILARITY else None
+        for score in scores
+    ]
+
+
+def batched(items, size):
+    iterator = iter(items)
+    while batch := list(itertools.islice(iterator, size)):
+        yield batch
+
+
+def parse_verdict(verdict):
+    # Tolerate "yes"/"no" strings as well as real booleans for the agency verdict.
+    is_agency = verdict.get("is_agency")
+    if isinstance(is_agency, str):
+        is_agency = {"yes": True, "no": False, "true": True, "false": False}.get(is_agency.strip().lower())
+    if not isinstance(is_agency, bool):
+        is_agency = None
+    analysis = str(verdict.get("analysis", "")).strip() or "GPT returned no analysis"
+    return {"is_agency": is_agency, "analysis": analysis}
+
+
+class VerdictStream:
+    # Pulls each finished {"id", "is_agency", "analysis"} object out of a
+    # streamed {"results": [...]} response as soon as its closing brace arrives
+    def __init__(self):
+        self.content = ""
+        self.position = None
+        self.decoder = json.JSONDecoder()
+
+    def feed(self, text):
+        self.content += text
+        if self.position is None:
+            start = self.content.find("[")
+            if start == -1:
+                return []
+            self.position = start + 1
+        verdicts = []
+        while True:
+            start = self.content.find("{", self.position)
+            if start == -1:
+                break
+            try:
+                verdict, self.position = self.decoder.raw_decode(self.content, start)
+            except ValueError:
+                break
+            if isinstance(verdict, dict):
+                verdicts.append(verdict)
+        return verdicts
+
+
+async def screen_batch(client, limiter, semaphore, batch, on_verdict):
+    # One fused request returns the agency verdict and the recruiter-fit
+    # analysis for every posting in the batch, in batch order. The response is
+    # streamed and on_verdict(job, verdict) fires as each posting's entry
+    # completes. The returned list is built from those same entries, so ones
+    # already delivered survive a reply cut off at max_tokens or a dropped
+    # connection; only postings whose entry never arrived get an error row.
+    # The semaphore and rate limiter keep the fan-out inside OpenAI's rate limits.
+    by_id = {}
+    async with semaphore:
+        try:
+            postings = "\n".join(
+                f"[{i}] Company: {job['company']}\n<<<{job['snippet']}>>>"
+                for i, job in enumerate(batch, start=1)
+            )
+            max_tokens = GPT_TOKENS_PER_JOB * len(batch)
+            screen_stream = await create_completion(
+                client, limiter,
+                # Rough prompt size at ~4 characters per token plus the output budget
+                (len(SCREENING_INSTRUCTIONS) + len(postings)) // 4 + max_tokens,
+                model=GPT_MODEL,
+                messages=[
+                    {"role": "system", "content": SCREENING_INSTRUCTIONS},
+                    {"role": "user", "content": postings}
+                ],
+                response_format={"type": "json_object"},
+                max_tokens=max_tokens,
+                temperature=0,
+                stream=True
+            )
+            verdicts = VerdictStream()
+            async for chunk in screen_stream:
+                if not chunk.choices or not chunk.choices[0].delta.content:
+                    continue
+                for verdict in verdicts.feed(chunk.choices[0].delta.content):
+                    try:
+                        index = int(verdict["id"])
+                    except (KeyError, TypeError, ValueError):
+                        continue
+                    # Ids are 1-based; 0 or a negative id would wrap to the end
+                    if not 1 <= index <= len(batch) or index in by_id:
+                        continue
+                    job = batch[index - 1]
+                    by_id[index] = parse_verdict(verdict)
+                    on_verdict(job, by_id[index])
+            limiter.record_success()
+            missing = {"is_agency": None, "analysis": "GPT returned no analysis", "error": True}
+        except (openai.APIError, httpx.HTTPError) as e:
+            # httpx errors cover a connection dropped mid-stream, which the SDK
+            # does not wrap once the response has started
+            missing = {"is_agency": None, "analysis": f"GPT error: {e}", "error": True}
+    return [by_id.get(i, missing) for i in range(1, len(batch) + 1)]
+
+
+def start_screening(client, limiter, jobs, on_verdict):
+    # Postings are packed GPT_BATCH_SIZE to a request so the shared instructions
+    # are sent once per batch. Every batch is its own future on the shared loop.
+    async def new_semaphore():
+        # Created on the loop it guards; older Pythons bind it at construction
+        return asyncio.Semaphore(GPT_CONCURRENCY)
+
+    semaphore = run_async(new_semaphore())
+    loop = get_event_loop()
+    return {
+        asyncio.run_coroutine_threadsafe(screen_batch(client, limiter, semaphore, batch, on_verdict), loop): batch
+        for batch in batched(jobs, GPT_BATCH_SIZE)
+    }
+
+
+def results_table(container, results):
+    # Sent to the browser as one Arrow table rather than Markdown to re-parse
+    container.dataframe(
+        pd.DataFrame(results, columns=RESULT_COLUMNS), column_config=RESULT_COLUMN_CONFIG,
+        hide_index=True, use_container_width=True
+    )
+
+
+def exclusions_panel(heading, exclusions_log, duplicates):
+    # The first rows as one table; the full log is offered as a CSV download
+    # rather than rendered
+    st.subheader(heading)
+    if duplicates:
+        st.caption(f"{duplicates} duplicate posting(s) removed before filtering")
+    if exclusions_log:
+        st.dataframe(
+            pd.DataFrame(exclusions_log[:EXCLUSIONS_SHOWN], columns=EXCLUSION_COLUMNS),
+            hide_index=True, use_container_width=True
+        )
+        st.download_button(
+            "Download all exclusions",
+            pd.DataFrame(exclusions_log, columns=EXCLUSION_COLUMNS).to_csv(index=False),
+            file_name="exclusions.csv", mime="text/csv"
+        )
+
+
+@st.cache_resource
+def get_agency_answer_bias():
+    # Pushes the one-token agency answer onto "Yes"/"No", with or without a
+    # leading space, so the model can't spend its single token on anything else
+    encoding = tiktoken.encoding_for_model(GPT_MODEL)
+    return {str(encoding.encode(word)[0]): 100 for word in ("Yes", "No", " Yes", " No")}
+
+
+def parse_agency_answers(content, count):
+    # The model is asked for {"answers": ["Yes"|"No", ...]} in company order;
+    # anything but one answer per company means the batch can't be trusted
+    answers = json.loads(content).get("answers")
+    if not isinstance(answers, list) or len(answers) != count:
+        raise ValueError(f"expected {count} answers, got {answers!r}")
+    return [{"yes": True, "no": False}.get(str(answer).strip().lower()) for answer in answers]
+
+
+async def classify_agencies(client, limiter, companies, logit_bias):
+    # Yes/No agency verdict per company, AGENCY_BATCH_SIZE companies to a
+    # request. A batch whose answer can't be parsed falls back to one
+    # single-token call per company. Returns True/False per company, or None
+    # when the call fails or the answer is unusable.
+    semaphore = asyncio.Semaphore(GPT_CONCURRENCY)
+
+    async def classify(company):
+        async with semaphore:
+            agency_check_prompt = f"Is the company '{company}' a staffing or recruiting agency?"
+            try:
+                agency_response = await create_completion(
+                    client, limiter,
+                    (len(AGENCY_CHECK_INSTRUCTIONS) + len(agency_check_prompt)) // 4 + 1,
+                    model=GPT_MODEL,
+                    messages=[
+                        {"role": "system", "content": AGENCY_CHECK_INSTRUCTIONS},
+                        {"role": "user", "content": agency_check_prompt}
+                    ],
+                    max_tokens=1,
+                    logit_bias=logit_bias,
+                    temperature=0
+                )
+            except openai.APIError:
+                return None
+            limiter.record_success()
+            answer = agency_response.choices[0].message.content or ""
+            return {"y": True, "n": False}.get(answer.strip()[:1].lower())
+
+    async def classify_batch(batch):
+        if len(batch) == 1:
+            return [await classify(batch[0])]
+        async with semaphore:
+            company_list = "\n".join(f"{i}. {company}" for i, company in enumerate(batch, start=1))
+            max_tokens = AGENCY_TOKENS_PER_COMPANY * len(batch) + AGENCY_TOKENS_OVERHEAD
+            try:
+                agency_response = await create_completion(
+                    client, limiter,
+                    (len(AGENCY_BATCH_INSTRUCTIONS) + len(company_list)) // 4 + max_tokens,
+                    model=GPT_MODEL,
+                    messages=[
+                        {"role": "system", "content": AGENCY_BATCH_INSTRUCTIONS},
+                        {"role": "user", "content": company_list}
+                    ],
+                    response_format={"type": "json_object"},
+                    max_tokens=max_tokens,
+                    temperature=0
+                )
+            except openai.APIError:
+                pass
+            else:
+                limiter.record_success()
+                try:
+                    return parse_agency_answers(agency_response.choices[0].message.content, len(batch))
+                except (AttributeError, TypeError, ValueError):
+                    pass
+        return await asyncio.gather(*[classify(company) for company in batch])
+
+    batches = await asyncio.gather(*[classify_batch(batch) for batch in batched(companies, AGENCY_BATCH_SIZE)])
+    return list(itertools.chain.from_iterable(batches))
+
+
+def agency_batches_key(api_key):
+    # The API key is hashed so it never lands on disk
+    return (AGENCY_BATCHES_KEY, hashlib.sha256(api_key.encode("utf-8")).hexdigest())
+
+
+def track_agency_batch(api_key, batch_id, custom_ids):
+    cache = get_gpt_cache()
+    key = agency_batches_key(api_key)
+    with cache.transact():
+        batches = cache.get(key, {})
+        batches[batch_id] = custom_ids
+        cache.set(key, batches)
+
+
+def untrack_agency_batch(api_key, batch_id):
+    cache = get_gpt_cache()
+    key = agency_batches_key(api_key)
+    with cache.transact():
+        batches = cache.get(key, {})
+        batches.pop(batch_id, None)
+        cache.set(key, batches)
+
+
+async def submit_agency_batch(client, companies, logit_bias):
+    # One Batch API job holding a single-token agency check per company, at
+    # half the price of live calls. companies maps company_norm to display
+    # name; returns the batch id and the custom_id -> company_norm mapping.
+    custom_ids = {}
+    lines = []
+    for i, (company_norm, company) in enumerate(companies.items()):
+        custom_id = f"agency-{i}"
+        custom_ids[custom_id] = company_norm
+        body = {
+            "model": GPT_MODEL,
+            "messages": [
+                {"role": "system", "content": AGENCY_CHECK_INSTRUCTIONS},
+                {"role": "user", "content": f"Is the company '{company}' a staffing or recruiting agency?"}
+            ],
+            "max_tokens": 1,
+            "temperature": 0
+        }
+        if logit_bias:
+            body["logit_bias"] = logit_bias
+        lines.append(json.dumps({"custom_id": custom_id, "method": "POST", "url": "/v1/chat/completions", "body": body}))
+    batch_file = await client.files.create(
+        file=("agency_checks.jsonl", "\n".join(lines).encode("utf-8")),
+        purpose="batch"
+    )
+    batch = await client.batches.create(
+        input_file_id=batch_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h"
+    )
+    return batch.id, custom_ids
+
+
+async def collect_agency_batch(client, batch_id, custom_ids, max_wait):
+    # Polls the batch with exponential backoff for up to max_wait seconds.
+    # Returns {company_norm: True/False/None} once the batch has ended, or
+    # None if it is still running.
+    deadline = time.monotonic() + max_wait
+    delay = 2
+    while True:
+        batch = await client.batches.retrieve(batch_id)
+        if batch.status in ("failed", "expired", "cancelled"):
+            return {}
+        if batch.status == "completed":
+            break
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return None
+        await asyncio.sleep(min(delay, remaining))
+        delay = min(delay * 2, 60)
+
+    verdicts = {}
+    if batch.output_file_id:
+        output = await client.files.content(batch.output_file_id)
+        for line in output.text.splitlines():
+            try:
+                record = json.loads(line)
+                answer = record["response"]["body"]["choices"][0]["message"]["content"]
+                verdicts[custom_ids[record["custom_id"]]] = {"y": True, "n": False}.get(answer.strip()[:1].lower())
+            except (KeyError, IndexError, TypeError, ValueError):
+                continue
+    return verdicts
+
+
+def harvest_agency_batches(client, api_key):
+    # Folds agency verdicts from this API key's Batch API jobs that finished
+    # since an earlier search into the verdict cache. A batch OpenAI no
+    # longer knows is dropped rather than polled forever.
+    for batch_id, custom_ids in get_gpt_cache().get(agency_batches_key(api_key), {}).items():
+        try:
+            verdicts = run_async(collect_agency_batch(client, batch_id, custom_ids, 0))
+        except openai.NotFoundError:
+            untrack_agency_batch(api_key, batch_id)
+            continue
+        except openai.APIError:
+            continue
+        if verdicts is None:
+            continue
+        for company_norm, is_agency in verdicts.items():
+            if is_agency is not None:
+                remember_agency_verdict(company_norm, is_agency)
+        untrack_agency_batch(api_key, batch_id)
+
+
+def dedupe_postings(jobs, seen):
+    # Drops postings whose (company, description) pair is already in seen,
+    # such as one posting syndicated by several aggregators. Returns the
+    # unique postings and how many were dropped.
+    unique = []
+    for job in jobs:
+        # Runs before filter_postings' per-job guard, so a null company is tolerated here
+        key = ((job.get("company") or {}).get("display_name", ""), hash(job.get("description", "") or ""))
+        if key not in seen:
+            seen.add(key)
+            unique.append(job)
+    return unique, len(jobs) - len(unique)
+
+
+def filter_postings(jobs, keyword_set, exclude_agencies, limit):
+    # Local filters that need no API call. Returns the candidate records and
+    # the (company, title, reason) log of everything ruled out. Without agency
+    # exclusion every candidate is kept, so collecting stops at the limit.
+    candidates = []
+    exclusions_log = []
+    for job in jobs:
+        try:
+            title = job.get("title", "")
+            company = job.get("company", {}).get("display_name", "N/A")
+            desc = job.get("description", "") or ""
+            url = job.get("redirect_url", "#")
+
+            # Cheapest checks first: the short title, then the full description.
+            # Each field is lowercased once, and the description only when the
+            # title check passes.
+            title_l = title.lower()
+            if keyword_set.isdisjoint(TOKEN_RE.findall(title_l)):
+                exclusions_log.append((company, title, "title does not match keyword"))
+                continue
+            if has_block_phrase(title_l) or has_block_phrase(desc.lower()):
+                exclusions_log.append((company, title, "contains 'no recruiters' language"))
+                continue
+            # Obvious agency names are rejected here, before any GPT call
+            company_l = company.lower()
+            if exclude_agencies and AGENCY_RE.search(company_l):
+                exclusions_log.append((company, title, "company name matched agency keyword"))
+                continue
+
+            candidates.append({
+                "company": company, "company_norm": normalize_company(company_l),
+                "title": title, "url": url, "desc": desc
+            })
+            if not exclude_agencies and len(candidates) >= limit:
+                break
+        except Exception as e:
+            exclusions_log.append(("Unknown", "Unknown", f"job parsing error: {e}"))
+            continue
+    return candidates, exclusions_log
+
+
+def pending_agency_companies(jobs, skip=()):
+    # Display name for each unclassified company, once per normalized name
+    pending = {}
+    for job in jobs:
+        if job["is_agency"] is None and job["company_norm"] not in skip:
+            pending.setdefault(job["company_norm"], job["company"])
+    return pending
+
+
+def apply_agency_verdicts(jobs, pending, answers):
+    verdicts = dict(zip(pending, answers))
+    for company_norm, is_agency in verdicts.items():
+        if is_agency is not None:
+            remember_agency_verdict(company_norm, is_agency)
+    for job in jobs:
+        if job["is_agency"] is None and verdicts.get(job["company_norm"]) is not None:
+            job["is_agency"] = verdicts[job["company_norm"]]
+            job["agency_reason"] = "GPT says 'yes' to agency"
+
 
 st.title("🛠 Debug Mode: AI-Powered US Job Search for Recruiters")
 
@@ -20,124 +857,310 @@ page_number = st.number_input("Page number to view", min_value=1, value=1, step=
 # Toggles
 enable_gpt_agency_check = st.checkbox("Enable GPT agency exclusion", value=True)
 enable_gpt_recruiter_check = st.checkbox("Enable GPT recruiter-fit analysis", value=True)
+use_batch_api = st.checkbox("Use Batch API for agency checks (cheaper, slower)", value=False)
+
+# OpenAI rate limits the GPT fan-out is paced to
+st.sidebar.subheader("⏱ OpenAI Rate Limits")
+max_requests_per_minute = st.sidebar.number_input("Max requests per minute", min_value=1, value=DEFAULT_MAX_REQUESTS_PER_MINUTE, step=100)
+max_tokens_per_minute = st.sidebar.number_input("Max tokens per minute", min_value=1000, value=DEFAULT_MAX_TOKENS_PER_MINUTE, step=1000)
 
 st.subheader("🔐 API Keys")
 adzuna_app_id = st.text_input("Adzuna App ID", type="password")
 adzuna_app_key = st.text_input("Adzuna App Key", type="password")
 openai_api_key = st.text_input("OpenAI API Key (starts with 'sk-')", type="password")
 
+# Results of the last search are kept in the session, so paging through them
+# costs no API call. Pressing Search Jobs always runs afresh, so a fixed key,
+# a passed outage or newly harvested Batch API verdicts are picked up. The
+# credentials are fingerprinted rather than kept in the key.
+credentials_fingerprint = hashlib.sha256(
+    "\0".join((adzuna_app_id, adzuna_app_key, openai_api_key)).encode("utf-8")
+).hexdigest()
+search_key = (
+    job_query, max_results, enable_gpt_agency_check, enable_gpt_recruiter_check, use_batch_api,
+    credentials_fingerprint
+)
+
 if st.button("Search Jobs"):
     if not job_query or not adzuna_app_id or not adzuna_app_key or not openai_api_key:
         st.error("Please enter all required fields.")
         st.stop()
 
-    openai_client = openai.OpenAI(api_key=openai_api_key)
-    all_jobs = []
-    num_pages = math.ceil(min(max_results, 100) / 50)
-
-    for page in range(1, num_pages + 1):
-        api_url = f"https://api.adzuna.com/v1/api/jobs/us/search/{page}"
-        params = {
-            "app_id": adzuna_app_id,
-            "app_key": adzuna_app_key,
-            "results_per_page": 50,
-            "what": job_query,
-            "content-type": "application/json"
-        }
+    openai_client = get_openai(openai_api_key)
+    openai_limiter = get_rate_limiter(openai_api_key)
+    openai_limiter.configure(max_requests_per_minute, max_tokens_per_minute)
+
+    # Page 1 alone shows how many postings survive the local filters, and
+    # only as many further pages as that yield calls for are fetched
+    keyword_set = frozenset(TOKEN_RE.findall(job_query.lower()))
+    try:
+        all_jobs = fetch_adzuna(job_query, (1,), adzuna_app_id, adzuna_app_key)
+    except Exception as e:
+        st.error(f"Failed to fetch jobs: {e}")
+        st.stop()
+    # Page 1's size is taken before dedupe, so duplicates on it don't make it
+    # look like the last page
+    first_page_count = len(all_jobs)
+    seen_postings = set()
+    all_jobs, duplicates = dedupe_postings(all_jobs, seen_postings)
+    candidates, exclusions_log = filter_postings(all_jobs, keyword_set, enable_gpt_agency_check, max_results)
+
+    extra_pages = extra_pages_needed(first_page_count, len(candidates), max_results)
+    if extra_pages:
         try:
-            response = requests.get(api_url, params=params)
-            response.raise_for_status()
-            data = response.json()
-            all_jobs.extend(data.get("results", []))
+            more_jobs = fetch_adzuna(job_query, tuple(range(2, 2 + extra_pages)), adzuna_app_id, adzuna_app_key)
         except Exception as e:
-            st.error(f"Failed to fetch page {page}: {e}")
-            break
-
-    keyword_words = job_query.lower().split()
-    fallback_terms = ["staffing", "recruiting", "recruitment", "talent", "consulting", "agency"]
+            st.warning(f"Failed to fetch more jobs: {e}")
+        else:
+            more_jobs, more_duplicates = dedupe_postings(more_jobs, seen_postings)
+            duplicates += more_duplicates
+            more_candidates, more_exclusions = filter_postings(
+                more_jobs, keyword_set, enable_gpt_agency_check, max_results - len(candidates)
+            )
+            candidates.extend(more_candidates)
+            exclusions_log.extend(more_exclusions)
     filtered_results = []
-    exclusions_log = []
 
-    for job in all_jobs:
+    if enable_gpt_agency_check:
+        harvest_agency_batches(openai_client, openai_api_key)
+
+    # Companies classified recently skip the GPT agency question; known
+    # agencies also skip the recruiter-fit analysis since they get excluded.
+    for job in candidates:
+        # GPT only ever sees the snippet, so postings sharing one share a verdict
+        job["snippet"] = job["desc"][:GPT_DESC_CHARS]
+        job["digest"] = description_digest(job["snippet"])
+        job["is_agency"] = cached_agency_verdict(job["company_norm"]) if enable_gpt_agency_check else None
+        job["agency_reason"] = "cached verdict: agency"
+
+    # Companies that clearly do or don't resemble a known agency are settled
+    # locally by embedding similarity; only borderline names go to GPT.
+    unknown = sorted({job["company_norm"] for job in candidates if enable_gpt_agency_check and job["is_agency"] is None})
+    if unknown:
         try:
-            title = job.get("title", "")
-            company = job.get("company", {}).get("display_name", "N/A")
-            desc = job.get("description", "") or ""
-            url = job.get("redirect_url", "#")
-            text = f"{title} {desc}".lower()
+            seeds = get_seed_embeddings(openai_api_key)
+            names = run_async(embed_texts(openai_client, unknown))
+            local_verdicts = dict(zip(unknown, classify_agencies_locally(names, seeds)))
+        except openai.APIError as e:
+            st.warning(f"Local agency classifier unavailable: {e}")
+        else:
+            for company_norm, is_agency in local_verdicts.items():
+                if is_agency is not None:
+                    remember_agency_verdict(company_norm, is_agency)
+            for job in candidates:
+                if job["is_agency"] is None and local_verdicts.get(job["company_norm"]) is not None:
+                    job["is_agency"] = local_verdicts[job["company_norm"]]
+                    job["agency_reason"] = "company name resembles a known agency"
 
-            if any(term in text for term in ["no recruiters", "no agencies", "no recruitment agencies"]):
-                exclusions_log.append((company, title, "contains 'no recruiters' language"))
-                continue
-            if not any(word in title.lower() for word in keyword_words):
-                exclusions_log.append((company, title, "title does not match keyword"))
-                continue
+    # Only the first max_results kept jobs are shown, so once that many
+    # candidates are confirmed keepers nothing after them needs GPT. Postings
+    # still awaiting a verdict are only over-requested by a fixed factor.
+    confirmed = 0
+    possible = 0
+    for index, job in enumerate(candidates):
+        if job["is_agency"] and enable_gpt_agency_check:
+            continue
+        possible += 1
+        if not enable_gpt_agency_check or job["is_agency"] is False:
+            confirmed += 1
+        if confirmed >= max_results or possible >= math.ceil(max_results * OVER_REQUEST_FACTOR):
+            candidates = candidates[:index + 1]
+            break
 
-            # GPT agency check
-            if enable_gpt_agency_check:
-                agency_answer = "unknown"
-                try:
-                    agency_check_prompt = (
-                        f"You are a business classifier. Only respond with 'Yes' or 'No'. "
-                        f"Is the company '{company}' a staffing or recruiting agency?"
-                    )
-                    agency_response = openai_client.chat.completions.create(
-                        model="gpt-3.5-turbo",
-                        messages=[{"role": "user", "content": agency_check_prompt}],
-                        max_tokens=5,
-                        temperature=0
-                    )
-                    agency_answer = agency_response.choices[0].message.content.strip().lower()
-                except:
-                    agency_answer = "error"
-
-                if agency_answer == "yes":
-                    exclusions_log.append((company, title, "GPT says 'yes' to agency"))
-                    continue
-                if agency_answer not in ["yes", "no"] or agency_answer == "error":
-                    if any(term in company.lower() for term in fallback_terms):
-                        exclusions_log.append((company, title, "fallback: company name matched agency keyword"))
-                        continue
+    # Postings analyzed before reuse that analysis; near-duplicates reuse the
+    # analysis of the most similar posting
+    needs_fit = [job for job in candidates if not job["is_agency"]] if enable_gpt_recruiter_check else []
+    for job in needs_fit:
+        analysis = cached_fit_analysis(job["digest"])
+        if analysis is not None:
+            job["analysis"] = analysis
+    needs_fit = [job for job in needs_fit if "analysis" not in job]
+    if needs_fit:
+        try:
+            embeddings = run_async(embed_texts(openai_client, [job["snippet"] for job in needs_fit]))
+        except openai.APIError as e:
+            st.warning(f"Semantic cache unavailable: {e}")
+        else:
+            for job, embedding, analysis in zip(needs_fit, embeddings, lookup_fit_analyses(embeddings)):
+                job["embedding"] = embedding
+                if analysis is not None:
+                    job["analysis"] = analysis
 
-            # Recruiter-fit analysis
-            analysis = "GPT recruiter-fit check skipped"
-            if enable_gpt_recruiter_check:
-                try:
-                    fit_prompt = (
-                        "You are an AI assistant helping a recruiter. Determine if the following job post "
-                        "suggests the company might be open to working with external recruiters. "
-                        "Keep your response to one or two sentences.\n"
-                        f"<<<{desc}>>>"
-                    )
-                    fit_response = openai_client.chat.completions.create(
-                        model="gpt-3.5-turbo",
-                        messages=[{"role": "user", "content": fit_prompt}],
-                        max_tokens=100,
-                        temperature=0
-                    )
-                    analysis = fit_response.choices[0].message.content.strip()
-                except Exception as e:
-                    analysis = f"GPT error: {e}"
-
-            filtered_results.append({
-                "Company": company,
-                "Job Title": title,
-                "Link": f"[Open Posting]({url})",
-                "AI Analysis": analysis
-            })
+    to_screen = [
+        job for job in candidates
+        if enable_gpt_recruiter_check and not job["is_agency"] and "analysis" not in job
+    ]
 
-            if len(filtered_results) >= max_results:
-                break
+    # Cross-listed postings (same company, identical description) are screened
+    # once and the verdict is shared by every copy
+    buckets = {}
+    for job in to_screen:
+        buckets.setdefault((job["company_norm"], job["digest"]), []).append(job)
+    groups = list(buckets.values())
+
+    logit_bias = None
+    if enable_gpt_agency_check and pending_agency_companies(candidates):
+        try:
+            logit_bias = get_agency_answer_bias()
         except Exception as e:
-            exclusions_log.append(("Unknown", "Unknown", f"job parsing error: {e}"))
+            st.warning(f"Yes/No token bias unavailable: {e}")
+
+    # Companies with no posting in the screening batches only need a Yes/No
+    # verdict, so their one-token checks run alongside the batches. With the
+    # Batch API they all wait for the single batch job after screening instead.
+    early_pending = {}
+    if enable_gpt_agency_check and not use_batch_api:
+        early_pending = pending_agency_companies(candidates, skip={job["company_norm"] for job in to_screen})
+    agency_future = None
+    if early_pending:
+        agency_future = asyncio.run_coroutine_threadsafe(
+            classify_agencies(openai_client, openai_limiter, list(early_pending.values()), logit_bias),
+            get_event_loop()
+        )
+
+    # GPT screening: agency check and recruiter-fit analysis fused into batched
+    # calls. Responses are streamed, and each posting is previewed as soon as
+    # its entry arrives rather than when the slowest batch finishes. The
+    # streamed verdicts cross from the event loop thread through a queue, since
+    # Streamlit calls must stay on the script thread.
+    streamed = queue.Queue()
+    futures = start_screening(
+        openai_client, openai_limiter, [group[0] for group in groups],
+        lambda job, verdict: streamed.put((job, verdict))
+    )
+    # Once enough keepers are known, batches that have not streamed anything
+    # yet are cancelled; batches already streaming are left to finish
+    batch_of = {id(job): future for future, batch in futures.items() for job in batch}
+    streaming = set()
+    screening_ids = {id(job) for job in to_screen}
+    settled = sum(
+        1 for job in candidates
+        if id(job) not in screening_ids and (not enable_gpt_agency_check or job["is_agency"] is False)
+    )
+    preview = st.empty()
+    preview_rows = []
+    keepers = 0
+    running = set(futures)
+    while running or not streamed.empty():
+        try:
+            job, verdict = streamed.get(timeout=0.1)
+        except queue.Empty:
+            running = {future for future in running if not future.done()}
+            continue
+        streaming.add(batch_of[id(job)])
+        # Same rule as the final table: an earlier verdict beats the streamed one
+        is_agency = job["is_agency"] if job["is_agency"] is not None else verdict["is_agency"]
+        if enable_gpt_agency_check and is_agency:
+            continue
+        preview_rows.append({
+            "Company": job["company"],
+            "Job Title": job["title"],
+            "Link": job["url"],
+            "AI Analysis": job.get("analysis", verdict["analysis"])
+        })
+        with preview.container():
+            st.markdown(f"### Screening… {len(preview_rows)} job(s) so far")
+            results_table(st, preview_rows)
+        # Rows still without an agency verdict may be excluded by the later
+        # checks, so only confirmed keepers count toward the cap
+        if not enable_gpt_agency_check or is_agency is False:
+            keepers += 1
+        if running and settled + keepers >= max_results:
+            for future in running - streaming:
+                future.cancel()
+    for future, batch in futures.items():
+        if future.cancelled():
+            continue
+        for job, screening in zip(batch, future.result()):
+            job["screening"] = screening
+    preview.empty()
+
+    # Postings whose batch was cancelled are dropped along with their copies
+    unscreened = [group for group in groups if "screening" not in group[0]]
+    if unscreened:
+        groups = [group for group in groups if "screening" in group[0]]
+        dropped = {id(job) for group in unscreened for job in group}
+        candidates = [job for job in candidates if id(job) not in dropped]
+
+    fresh = []
+    for group in groups:
+        screening = group[0]["screening"]
+        # A cached or local verdict wins over GPT's; GPT's answer is only
+        # cached for companies that had no verdict yet
+        unclassified = group[0]["is_agency"] is None
+        for job in group:
+            if "analysis" not in job:
+                job["analysis"] = screening["analysis"]
+                if job is group[0] and not screening.get("error"):
+                    remember_fit_analysis(job["digest"], job["analysis"])
+                    if "embedding" in job:
+                        fresh.append(job)
+            if job["is_agency"] is None and screening["is_agency"] is not None:
+                job["is_agency"] = screening["is_agency"]
+                job["agency_reason"] = "GPT says 'yes' to agency"
+        if unclassified and screening["is_agency"] is not None:
+            remember_agency_verdict(group[0]["company_norm"], screening["is_agency"])
+    if fresh:
+        remember_fit_analyses(np.stack([job["embedding"] for job in fresh]), [job["analysis"] for job in fresh])
+
+    if agency_future:
+        apply_agency_verdicts(candidates, early_pending, agency_future.result())
+
+    # Companies still without a verdict get the one-token check, live or as a
+    # single Batch API job. A batch that outlives the wait is tracked and
+    # harvested by a later search; until then those companies are kept.
+    late_pending = pending_agency_companies(candidates) if enable_gpt_agency_check else {}
+    if late_pending and use_batch_api:
+        try:
+            with st.spinner(f"Waiting on Batch API agency checks for {len(late_pending)} companies…"):
+                batch_id, custom_ids = run_async(submit_agency_batch(openai_client, late_pending, logit_bias))
+                verdicts = run_async(collect_agency_batch(openai_client, batch_id, custom_ids, BATCH_API_MAX_WAIT))
+        except openai.APIError as e:
+            st.warning(f"Batch API agency check failed: {e}")
+        else:
+            if verdicts is None:
+                track_agency_batch(openai_api_key, batch_id, custom_ids)
+                st.info("Batch API agency checks are still running; their verdicts will apply to later searches.")
+            else:
+                apply_agency_verdicts(candidates, late_pending, [verdicts.get(norm) for norm in late_pending])
+    elif late_pending:
+        answers = run_async(classify_agencies(openai_client, openai_limiter, list(late_pending.values()), logit_bias))
+        apply_agency_verdicts(candidates, late_pending, answers)
+
+    for job in candidates:
+        if len(filtered_results) >= max_results:
+            break
+        company, title = job["company"], job["title"]
+
+        if enable_gpt_agency_check and job["is_agency"]:
+            exclusions_log.append((company, title, job["agency_reason"]))
             continue
 
+        analysis = "GPT recruiter-fit check skipped"
+        if enable_gpt_recruiter_check:
+            analysis = job["analysis"]
+
+        filtered_results.append({
+            "Company": company,
+            "Job Title": title,
+            "Link": job["url"],
+            "AI Analysis": analysis
+        })
+
+    st.session_state["search_key"] = search_key
+    st.session_state["results"] = filtered_results
+    st.session_state["exclusions_log"] = exclusions_log
+    st.session_state["duplicates"] = duplicates
+
+if st.session_state.get("search_key") == search_key:
+    filtered_results = st.session_state["results"]
+    exclusions_log = st.session_state["exclusions_log"]
+    duplicates = st.session_state["duplicates"]
+
     if not filtered_results:
         st.warning("No jobs passed the filters.")
-        if exclusions_log:
-            st.subheader("🧾 Exclusion Reasons")
-            for company, title, reason in exclusions_log[:30]:
-                st.text(f"- {company} | {title} | Reason: {reason}")
+        if exclusions_log or duplicates:
+            exclusions_panel("🧾 Exclusion Reasons", exclusions_log, duplicates)
         st.stop()
 
     total_pages = math.ceil(len(filtered_results) / page_size)
@@ -150,11 +1173,7 @@ if st.button("Search Jobs"):
     display = filtered_results[start:end]
 
     st.markdown(f"### Showing results {start+1}–{min(end, len(filtered_results))} of {len(filtered_results)}")
-    header = "| Company | Job Title | Posting Link | AI Analysis |\n|---|---|---|---|"
-    rows = [f"| {r['Company']} | {r['Job Title']} | {r['Link']} | {r['AI Analysis']} |" for r in display]
-    st.markdown(header + "\n" + "\n".join(rows), unsafe_allow_html=True)
+    results_table(st, display)
 
-    if exclusions_log:
-        st.subheader("🧾 Jobs Excluded and Why (First 30)")
-        for company, title, reason in exclusions_log[:30]:
-            st.text(f"- {company} | {title} | Reason: {reason}")
+    if exclusions_log or duplicates:
+        exclusions_panel(f"🧾 Jobs Excluded and Why (First {EXCLUSIONS_SHOWN})", exclusions_log, duplicates)